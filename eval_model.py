@@ -8,6 +8,7 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 from model.model import MiniMindLM
 from model.LMConfig import LMConfig
 from model.model_lora import *
+from model.model_int8 import apply_int8
 
 warnings.filterwarnings('ignore')
 
@@ -32,6 +33,10 @@ def init_model(args):
         if args.lora_name != 'None':
             apply_lora(model)
             load_lora(model, f'./{args.out_dir}/lora/{args.lora_name}_{args.dim}.pth')
+
+        if args.int8:
+            # 推理时把Attention与FeedForward的权重量化为INT8(W8A16)，减少解码时读取权重的带宽
+            apply_int8(model, args.device)
     else:
         transformers_model_path = './MiniMind2'
         tokenizer = AutoTokenizer.from_pretrained(transformers_model_path)
@@ -116,6 +121,7 @@ def main():
     parser.add_argument('--n_layers', default=8, type=int)
     parser.add_argument('--max_seq_len', default=8192, type=int)
     parser.add_argument('--use_moe', default=False, type=bool)
+    parser.add_argument('--int8', default=False, type=bool, help="是否将Attention与FeedForward的权重量化为INT8推理")
     # 携带历史对话上下文条数
     # history_cnt需要设为偶数，即【用户问题, 模型回答】为1组；设置为0时，即当前query不携带历史上文
     # 模型未经过外推微调时，在更长的上下文的chat_template时难免出现性能的明显退化，因此需要注意此处设置
@@ -19,6 +19,7 @@ class LMConfig(PretrainedConfig):
             rope_theta: int = 1e6,
             dropout: float = 0.0,
             flash_attn: bool = True, # 是否使用Flash-Attention
+            compile_model: bool = False, # 是否用torch.compile(CUDA Graphs)编译forward，减少解码时的kernel launch开销
             ####################################################
             # Here are the specific configurations of MOE
             # When use_moe is false, the following is invalid
@@ -46,6 +47,7 @@ class LMConfig(PretrainedConfig):
         self.rope_theta = rope_theta
         self.dropout = dropout
         self.flash_attn = flash_attn
+        self.compile_model = compile_model
         ####################################################
         # Here are the specific configurations of MOE
         # When use_moe is false, the following is invalid
@@ -20,40 +20,42 @@ class RMSNorm(torch.nn.Module):
         self.weight = nn.Parameter(torch.ones(dim))
 
     def forward(self, x):
-        return self.weight * (x.float() * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)).type_as(x)
+        # PyTorch>=2.4提供融合的F.rms_norm，一个kernel完成规约、缩放与乘weight；它只在x与weight同dtype时走融合实现
+        if hasattr(F, 'rms_norm') and x.dtype == self.weight.dtype:
+            return F.rms_norm(x, (x.shape[-1],), weight=self.weight, eps=self.eps)
+        # 只有shape为(...,1)的均方根规约在float32下累加，再转回x的dtype，避免为整个x生成一份float32的拷贝
+        inv_rms = torch.rsqrt(x.pow(2).mean(-1, keepdim=True, dtype=torch.float32) + self.eps).type_as(x)
+        return self.weight * (x * inv_rms)
 
 
 def precompute_pos_cis(dim: int, end: int = int(32 * 1024), theta: float = 1e6):
     """
-    为每个token的位置信息生成对应的幅角值
+    为每个token的位置信息生成对应的幅角值，并以实数形式的(cos, sin)返回
     这里的dim指的是head_dim，也就是单个注意力头的维度
     """
     # dim//2的目的是保证即使dim是奇数，生成的旋转矩阵也是偶数
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
     t = torch.arange(end, device=freqs.device)  # type: ignore ,生成长度为seq_len的序列
     freqs = torch.outer(t, freqs).float()  # type: ignore ,与幅角值做外积，生成shape为(seq_len, dim//2)的矩阵
-    pos_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64,计算幅角的cos与sin，以复数形式保存
-    return pos_cis
-
-
-def apply_rotary_emb(xq, xk, pos_cis):
-    """应用旋转嵌入"""
-    def unite_shape(pos_cis, x):
-        ndim = x.ndim # x.shape:(bsz,seq_len,nums_head,head_dim/2)
-        assert 0 <= 1 < ndim # -> assert 1 < ndim
-        assert pos_cis.shape == (x.shape[1], x.shape[-1])
-        shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)] # shape:(1,seq_len,1,head_dim/2)
-        return pos_cis.view(*shape) # shape:(1,seq_len,1,head_dim/2)
-
-    # xq,xk,shape:(bsz,seq_len,nums_head,head_dim)->shape(bsz,seq_len,nums_head,head_dim/2,2)
-    # 应用完view_as_complex之后xq_,xk_的shape:(bsz,seq_len,nums_head,head_dim/2)
-    xq_ = torch.view_as_complex(xq.float().reshape(*xq.shape[:-1], -1, 2))
-    xk_ = torch.view_as_complex(xk.float().reshape(*xk.shape[:-1], -1, 2))
-    pos_cis = unite_shape(pos_cis, xq_) # 统一旋转角度矩阵跟qk矩阵的形状，方便相乘
-    #(bsz,seq_len,nums_head,head_dim/2)->(bsz,seq_len,nums_head,head_dim/2,2)->(bsz,seq_len,nums_head,head_dim)
-    xq_out = torch.view_as_real(xq_ * pos_cis).flatten(3) # 矩阵逐位相乘后转成实数域
-    xk_out = torch.view_as_real(xk_ * pos_cis).flatten(3) 
-    return xq_out.type_as(xq), xk_out.type_as(xk)
+    # 不再用torch.polar保存为complex64，直接保存实数的cos与sin，可随模型一起转换为bf16/fp16
+    return torch.cos(freqs), torch.sin(freqs)
+
+
+def apply_rotary_emb(xq, xk, cos, sin):
+    """应用旋转嵌入，用实数形式计算 (x1 + i*x2) * (cos + i*sin)，避免转为complex64及float32的往返"""
+    # cos,sin shape:(seq_len,head_dim/2)->(1,seq_len,1,head_dim/2)，并与xq保持相同dtype
+    cos = cos[None, :, None, :].to(xq.dtype)
+    sin = sin[None, :, None, :].to(xq.dtype)
+
+    def rotate(x):
+        # 只用unflatten/stack/flatten这类纯张量运算，不涉及complex dtype，torch.compile可以fullgraph编译并与前后算子融合
+        # x shape:(bsz,seq_len,nums_head,head_dim)->(bsz,seq_len,nums_head,head_dim/2,2)，最后一维为(实部,虚部)
+        x_ = x.unflatten(-1, (-1, 2))
+        x1, x2 = x_[..., 0], x_[..., 1]
+        # (bsz,seq_len,nums_head,head_dim/2,2)->(bsz,seq_len,nums_head,head_dim)
+        return torch.stack((x1 * cos - x2 * sin, x1 * sin + x2 * cos), dim=-1).flatten(-2)
+
+    return rotate(xq), rotate(xk)
 
 
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -80,9 +82,10 @@ class Attention(nn.Module):
         self.n_local_kv_heads = self.n_kv_heads
         self.n_rep = self.n_local_heads // self.n_local_kv_heads # 几个query共享kv，是float,//是int
         self.head_dim = args.dim // args.n_heads # 单个注意力头的维度
-        self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
-        self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
-        self.wv = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
+        self.max_seq_len = args.max_seq_len # kv缓存按最大长度一次性预分配
+        # q,k,v的投影合并为一个nn.Linear，对同一个x只做一次GEMM，输出再按(n_heads,n_kv_heads,n_kv_heads)*head_dim切分
+        self.qkv_split = [args.n_heads * self.head_dim, self.n_kv_heads * self.head_dim, self.n_kv_heads * self.head_dim]
+        self.wqkv = nn.Linear(args.dim, sum(self.qkv_split), bias=False)
         self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
         self.attn_dropout = nn.Dropout(args.dropout)
         self.resid_dropout = nn.Dropout(args.dropout) #resid：residual残差
@@ -90,60 +93,97 @@ class Attention(nn.Module):
         # pytorch中使用torch.nn.functional.scaled_dot_product_attention 函数提供了对 Flash Attention 的支持，
         # 所以需要检测当前版本的pytorch是否有该函数以及我们的配置类LMConfig有没有启用flash_attn
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention') and args.flash_attn
+        # PyTorch>=2.5的scaled_dot_product_attention支持enable_gqa，kv头数少于q头数时在内核内部广播，不必再用repeat_kv复制kv
+        self.enable_gqa = self.flash and self.n_rep > 1 and torch.__version__ >= '2.5'
         # print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
-        mask = torch.full((1, 1, args.max_seq_len, args.max_seq_len), float("-inf")) # 创建一个shape为(1,1,max_seq_len,max_seq_len),值为-inf的mask
-        mask = torch.triu(mask, diagonal=1) # 将mask转为上三角矩阵,diagonal=1表示是否考虑对角线元素置为0，1表示考虑
-        self.register_buffer("mask", mask, persistent=False) # 注册成缓冲区不参与梯度计算，persistent=False表示缓冲区是否应该被保存为模型状态的一部分
+        if not self.flash:
+            # 只有不使用flash时才需要显式的mask，flash路径靠is_causal实现因果遮蔽，省去max_seq_len**2大小的buffer
+            mask = torch.full((1, 1, args.max_seq_len, args.max_seq_len), float("-inf")) # 创建一个shape为(1,1,max_seq_len,max_seq_len),值为-inf的mask
+            mask = torch.triu(mask, diagonal=1) # 将mask转为上三角矩阵,diagonal=1表示是否考虑对角线元素置为0，1表示考虑
+            self.register_buffer("mask", mask, persistent=False) # 注册成缓冲区不参与梯度计算，persistent=False表示缓冲区是否应该被保存为模型状态的一部分
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧的checkpoint：把分开的wq,wk,wv权重按顺序拼接成wqkv
+        keys = [f'{prefix}{name}.weight' for name in ('wq', 'wk', 'wv')]
+        if all(k in state_dict for k in keys):
+            state_dict[f'{prefix}wqkv.weight'] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self,
                 x: torch.Tensor,
-                pos_cis: torch.Tensor,
-                past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
-                use_cache=False):
+                pos_cis: Tuple[torch.Tensor, torch.Tensor],
+                past_key_value: Optional[Tuple[torch.Tensor, torch.Tensor, int]] = None,
+                use_cache=False,
+                start_pos: int = 0,
+                attn_mask: Optional[torch.Tensor] = None):
         bsz, seq_len, _ = x.shape
-        xq, xk, xv = self.wq(x), self.wk(x), self.wv(x) # 执行x@wq,x@wk,x@wv操作，得到query,key,value矩阵
+        xq, xk, xv = self.wqkv(x).split(self.qkv_split, dim=-1) # 执行x@wqkv操作后切分，得到query,key,value矩阵
         xq = xq.view(bsz, seq_len, self.n_local_heads, self.head_dim)
         xk = xk.view(bsz, seq_len, self.n_local_kv_heads, self.head_dim)
         xv = xv.view(bsz, seq_len, self.n_local_kv_heads, self.head_dim)
 
-        xq, xk = apply_rotary_emb(xq, xk, pos_cis) # 为qk添加位置信息
+        xq, xk = apply_rotary_emb(xq, xk, *pos_cis) # 为qk添加位置信息
         """
             kv_cache实现，只在推理时启用，模型训练时不启用
-            past_key_value:(past_key,past_value)
-            past_key, past_value shape 都是(bsz,seq_len,n_kv_heads,head_dim)
-        """ 
-        if past_key_value is not None:
-            xk = torch.cat([past_key_value[0], xk], dim=1) # 按seq_len维度拼接，拼接之后长度是seq_len+1
-            xv = torch.cat([past_key_value[1], xv], dim=1)
-        past_kv = (xk, xv) if use_cache else None
-
+            past_key_value:(k_cache,v_cache,cache_len)
+            k_cache, v_cache shape 都是(bsz,max_seq_len,n_kv_heads,head_dim)，在首次前向时预分配，
+            之后每步把新的k,v原地写入[start_pos, start_pos+seq_len)，避免torch.cat每步重新分配并拷贝整段缓存
+        """
+        past_kv = None
+        if use_cache or past_key_value is not None:
+            if past_key_value is None:
+                # 只会读取已写入的[:end_pos]部分，无需清零
+                k_cache = xk.new_empty(bsz, self.max_seq_len, self.n_local_kv_heads, self.head_dim)
+                v_cache = torch.empty_like(k_cache)
+            else:
+                k_cache, v_cache, _ = past_key_value
+            end_pos = start_pos + seq_len
+            k_cache[:, start_pos:end_pos].copy_(xk)
+            v_cache[:, start_pos:end_pos].copy_(xv)
+            xk, xv = k_cache[:, :end_pos], v_cache[:, :end_pos] # 只是切片视图，不发生拷贝
+            past_kv = (k_cache, v_cache, end_pos) if use_cache else None
+
+        if not self.enable_gqa:
+            # (bsz,seq_len,n_kv_heads,head_dim)->(bsz,seq_len,n_kv_heads*n_rep,head_dim)
+            xk, xv = repeat_kv(xk, self.n_rep), repeat_kv(xv, self.n_rep)
         xq, xk, xv = (
             xq.transpose(1, 2), # (bsz,seq_len,n_local_heads,head_dim)->(bsz,n_local_heads,seq_len,head_dim)
-            repeat_kv(xk, self.n_rep).transpose(1, 2), # (bsz,seq_len,n_kv_heads,head_dim)->(bsz,n_kv_heads*n_rep,seq_len,head_dim)
-            repeat_kv(xv, self.n_rep).transpose(1, 2)  # (bsz,seq_len,n_kv_heads,head_dim)->(bsz,n_kv_heads*n_rep,seq_len,head_dim)
+            xk.transpose(1, 2), # (bsz,seq_len,n_kv_heads,head_dim)->(bsz,n_kv_heads,seq_len,head_dim)
+            xv.transpose(1, 2)
         )
-        # 这里的seq_len!=1是为了避免在训练时使用flash attention，因为flash attention要求输入序列长度大于1
-        if self.flash and seq_len != 1:
+        if self.flash:
             # self.training来自nn.Module,
             # 当你调用 model.train() 时，会将 self.training 设置为 True，表示模型处于训练模式。
             # 当你调用 model.eval() 时，会将 self.training 设置为 False，表示模型处于评估模式
             dropout_p = self.dropout if self.training else 0.0
+            # 低版本PyTorch的scaled_dot_product_attention没有enable_gqa参数，只在支持时传入
+            gqa_kwargs = {'enable_gqa': True} if self.enable_gqa else {}
+            # 增量解码时seq_len==1，唯一的query可以看到全部kv，天然满足因果性，因此不需要is_causal
+            # 传入attn_mask(批量生成时含padding)时，因果遮蔽已包含在attn_mask中
             output = F.scaled_dot_product_attention(
                 xq, xk, xv,
-                attn_mask=None,
+                attn_mask=attn_mask,
                 dropout_p=dropout_p,
-                is_causal=True
+                is_causal=attn_mask is None and seq_len != 1,
+                **gqa_kwargs
             )
         else:
             scores = (xq @ xk.transpose(-2, -1)) / math.sqrt(self.head_dim)
-            scores += self.mask[:, :, :seq_len, :seq_len] # 别忘记mask的shape的最后俩个维度是什么（是max_seq_len）
+            if attn_mask is not None:
+                scores = scores.masked_fill(~attn_mask, float('-inf'))
+            else:
+                scores += self.mask[:, :, :seq_len, :seq_len] # 别忘记mask的shape的最后俩个维度是什么（是max_seq_len）
             scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-            scores = self.attn_dropout(scores)
+            if self.training and self.attn_dropout.p > 0:
+                scores = self.attn_dropout(scores)
             output = scores @ xv
 
         # (bsz,n_local_heads,seq_len,head_dim)->(bsz,seq_len,n_local_heads,head_dim)->(bsz,seq_len,dim)
         output = output.transpose(1, 2).reshape(bsz, seq_len, -1) 
-        output = self.resid_dropout(self.wo(output))
+        output = self.wo(output)
+        # 推理时nn.Dropout虽然是恒等映射，仍会经过一次模块调用，因此只在训练且dropout>0时调用
+        if self.training and self.resid_dropout.p > 0:
+            output = self.resid_dropout(output)
         return output, past_kv
 
 
@@ -156,14 +196,25 @@ class FeedForward(nn.Module):
             # 乘以8/3之后可能不是2的倍数，使SwiGLU后隐藏层大小为2的倍数，优化计算效率的参数
             config.hidden_dim = config.multiple_of * ((hidden_dim + config.multiple_of - 1) // config.multiple_of)
         # 不使用bias是因为bias会过度拟合训练数据，导致模型泛化能力变差
-        self.w1 = nn.Linear(config.dim, config.hidden_dim, bias=False)
+        # w1(门控)与w3(升维)作用于同一个x，合并为一个输出维度为2*hidden_dim的w13，只做一次GEMM
+        self.w13 = nn.Linear(config.dim, 2 * config.hidden_dim, bias=False)
         self.w2 = nn.Linear(config.hidden_dim, config.dim, bias=False)
-        self.w3 = nn.Linear(config.dim, config.hidden_dim, bias=False)
         self.dropout = nn.Dropout(config.dropout)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧的checkpoint：把分开的w1,w3权重拼接成w13
+        keys = [f'{prefix}w1.weight', f'{prefix}w3.weight']
+        if all(k in state_dict for k in keys):
+            state_dict[f'{prefix}w13.weight'] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        # 通过w1对隐藏层升维,通过w3对隐藏层升维后通过激活函数，两者逐位相乘后，再通过w2降维恢复原来的隐藏层大小
-        return self.dropout(self.w2(F.silu(self.w1(x)) * self.w3(x)))
+        # w13的前一半是门控(原w1)，通过激活函数后与后一半(原w3)的升维结果逐位相乘，再通过w2降维恢复原来的隐藏层大小
+        gate, up = self.w13(x).chunk(2, dim=-1)
+        out = self.w2(F.silu(gate) * up)
+        if self.training and self.dropout.p > 0:
+            out = self.dropout(out)
+        return out
 
 
 class MoEGate(nn.Module):
@@ -198,9 +249,15 @@ class MoEGate(nn.Module):
             raise NotImplementedError(f'insupportable scoring function for MoE gating: {self.scoring_func}')
 
         # topk_weight shape(bsz*seq_len,top_k)
-        # 小tips：sorted参数在windows上不管是true还是false，结果都是已排序的，在linux则不会
-        topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=False)
+        if self.top_k == 1:
+            # 只选一个专家时argmax+gather比通用的topk更便宜，且不存在下面提到的平台差异
+            topk_idx = scores.argmax(dim=-1, keepdim=True)
+            topk_weight = scores.gather(-1, topk_idx)
+        else:
+            # 小tips：sorted参数在windows上不管是true还是false，结果都是已排序的，在linux则不会
+            topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=False)
 
+        # top_k为1时归一化后恒为1，因此只在top_k>1时归一化
         if self.top_k > 1 and self.norm_topk_prob:
             # denominator：分母
             denominator = topk_weight.sum(dim=-1, keepdim=True) + 1e-20
@@ -242,15 +299,57 @@ class MOEFeedForward(nn.Module):
     def __init__(self, config: LMConfig):
         super().__init__()
         self.config = config
-        # 每个专家本质上就是个dense model的feedforward
-        self.experts = nn.ModuleList([
-            FeedForward(config)
-            for _ in range(config.n_routed_experts)
-        ])
+        # 每个专家本质上就是个dense model的feedforward，
+        # 这里把所有专家的权重堆叠成(n_routed_experts, out, in)的张量，推理时用一次torch.bmm算完所有专家，而不是每个专家各launch三次nn.Linear
+        experts = [FeedForward(config) for _ in range(config.n_routed_experts)]
+        self.w13_stack = nn.Parameter(torch.stack([e.w13.weight.data for e in experts])) # shape(n_routed_experts,2*hidden_dim,dim)
+        self.w2_stack = nn.Parameter(torch.stack([e.w2.weight.data for e in experts])) # shape(n_routed_experts,dim,hidden_dim)
+        self.dropout = nn.Dropout(config.dropout)
         self.gate = MoEGate(config)
         if config.n_shared_experts is not None:
             self.shared_experts = FeedForward(config)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容旧的checkpoint：把experts.{i}.w1.weight这类逐专家的权重堆叠成w1_stack，再像FeedForward.w13一样拼接w1与w3
+        for name in ('w1', 'w2', 'w3'):
+            keys = [f'{prefix}experts.{i}.{name}.weight' for i in range(self.config.n_routed_experts)]
+            if all(k in state_dict for k in keys):
+                state_dict[f'{prefix}{name}_stack'] = torch.stack([state_dict.pop(k) for k in keys])
+        keys = [f'{prefix}w1_stack', f'{prefix}w3_stack']
+        if all(k in state_dict for k in keys):
+            state_dict[f'{prefix}w13_stack'] = torch.cat([state_dict.pop(k) for k in keys], dim=1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def grouped_forward(self, x, expert_ids, counts):
+        """
+        计算已按专家排好序的token
+        x:已按专家排好序的token,shape(N,dim)  expert_ids:每个token对应的专家,shape(N,)
+        counts:每个专家分到的token数,shape(n_routed_experts,)
+        """
+        counts_list = counts.tolist() # 每层唯一一次显式的host同步
+        if min(counts_list) == 0:
+            # 有专家没分到token时(如bsz=1解码)，只对有token的专家逐个计算，不读取空专家的权重
+            outs, start = [], 0
+            for i, n in enumerate(counts_list):
+                if n:
+                    gate, up = F.linear(x[start:start + n], self.w13_stack[i]).chunk(2, dim=-1)
+                    outs.append(F.linear(F.silu(gate) * up, self.w2_stack[i]))
+                start += n
+            out = torch.cat(outs)
+        else:
+            # 所有专家都有token时，用batched GEMM一次算完所有专家
+            # 每个token在自己专家分段内的位置，据此把x放进shape为(n_routed_experts,capacity,dim)的padding张量
+            pos = torch.arange(x.size(0), device=x.device) - (counts.cumsum(0) - counts)[expert_ids]
+            padded = x.new_zeros(self.config.n_routed_experts, max(counts_list), x.size(-1))
+            padded[expert_ids, pos] = x
+            gate, up = torch.bmm(padded, self.w13_stack.transpose(1, 2)).chunk(2, dim=-1)
+            h = F.silu(gate) * up
+            out = torch.bmm(h, self.w2_stack.transpose(1, 2)) # shape(n_routed_experts,capacity,dim)
+            out = out[expert_ids, pos]
+        if self.training and self.dropout.p > 0:
+            out = self.dropout(out)
+        return out
+
     def forward(self, x):
         identity = x
         orig_shape = x.shape
@@ -260,11 +359,12 @@ class MOEFeedForward(nn.Module):
         x = x.view(-1, x.shape[-1])
         flat_topk_idx = topk_idx.view(-1)
         if self.training:
-            # 训练模式下，重复输入数据
-            x = x.repeat_interleave(self.config.num_experts_per_tok, dim=0)
-            y = torch.empty_like(x, dtype=torch.float16)
-            for i, expert in enumerate(self.experts):
-                y[flat_topk_idx == i] = expert(x[flat_topk_idx == i]).to(y.dtype)  # 确保类型一致
+            # 训练模式下，每个token的top_k个(token,专家)对按专家排序一次，
+            # 用grouped_forward一次算完所有专家，代替逐专家的布尔掩码、gather与scatter
+            idxs = flat_topk_idx.argsort()
+            counts = torch.bincount(flat_topk_idx, minlength=self.config.n_routed_experts)
+            expert_out = self.grouped_forward(x[idxs // self.config.num_experts_per_tok], flat_topk_idx[idxs], counts)
+            y = expert_out[idxs.argsort()] # 恢复成排序前的顺序，shape(bsz*seq_len*top_k,dim)
             y = (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1)
             y = y.view(*orig_shape)
         else:
@@ -279,22 +379,17 @@ class MOEFeedForward(nn.Module):
     def moe_infer(self, x, flat_expert_indices, flat_expert_weights):
         expert_cache = torch.zeros_like(x)
         idxs = flat_expert_indices.argsort()
-        tokens_per_expert = flat_expert_indices.bincount().cpu().numpy().cumsum(0)
+        # 留在device上计算，不再.cpu().numpy()把整段计数拷回host，grouped_forward中只取回一次
+        counts = torch.bincount(flat_expert_indices, minlength=self.config.n_routed_experts)
         token_idxs = idxs // self.config.num_experts_per_tok
-        # 例如当tokens_per_expert=[6, 15, 20, 26, 33, 38, 46, 52]
+        # 例如当各专家的token数累加为[6, 15, 20, 26, 33, 38, 46, 52]
         # 当token_idxs=[3, 7, 19, 21, 24, 25,  4,  5,  6, 10, 11, 12...]
         # 意味着当token_idxs[:6] -> [3,  7, 19, 21, 24, 25,  4]位置的token都由专家0处理，token_idxs[6:15]位置的token都由专家1处理......
-        for i, end_idx in enumerate(tokens_per_expert):
-            start_idx = 0 if i == 0 else tokens_per_expert[i - 1]
-            if start_idx == end_idx:
-                continue
-            expert = self.experts[i]
-            exp_token_idx = token_idxs[start_idx:end_idx]
-            expert_tokens = x[exp_token_idx]
-            expert_out = expert(expert_tokens).to(expert_cache.dtype)
-            expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
-            # 使用 scatter_add_ 进行 sum 操作
-            expert_cache.scatter_add_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out)
+        # 排好序之后各专家的token是连续的分段，交给grouped_forward统一计算
+        expert_out = self.grouped_forward(x[token_idxs], flat_expert_indices[idxs], counts)
+        expert_out = expert_out.to(expert_cache.dtype).mul_(flat_expert_weights[idxs])
+        # 使用 index_add_ 进行 sum 操作，一维索引即可，无需像scatter_add_那样repeat出(N,dim)的索引张量
+        expert_cache.index_add_(0, token_idxs, expert_out)
 
         return expert_cache
 
@@ -313,12 +408,14 @@ class MiniMindBlock(nn.Module):
         self.ffn_norm = RMSNorm(config.dim, eps=config.norm_eps)
         self.feed_forward = FeedForward(config) if not config.use_moe else MOEFeedForward(config)
 
-    def forward(self, x, pos_cis, past_key_value=None, use_cache=False):
+    def forward(self, x, pos_cis, past_key_value=None, use_cache=False, start_pos=0, attn_mask=None):
         h_attn, past_kv = self.attention(
             self.attention_norm(x),
             pos_cis,
             past_key_value=past_key_value,
-            use_cache=use_cache
+            use_cache=use_cache,
+            start_pos=start_pos,
+            attn_mask=attn_mask
         )
         h = x + h_attn
         out = h + self.feed_forward(self.ffn_norm(h))
@@ -338,33 +435,58 @@ class MiniMindLM(PreTrainedModel):
         self.tok_embeddings = nn.Embedding(params.vocab_size, params.dim)
         self.dropout = nn.Dropout(params.dropout)
         self.layers = nn.ModuleList([MiniMindBlock(l, params) for l in range(self.n_layers)])
+        # 预先记下使用MoE的层，forward中不必每次都对所有层做isinstance检查
+        self._moe_layer_indices = [i for i, l in enumerate(self.layers) if isinstance(l.feed_forward, MOEFeedForward)]
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
         self.output = nn.Linear(params.dim, params.vocab_size, bias=False)
         self.tok_embeddings.weight = self.output.weight # 嵌入层跟输出层的权重共享,实际上是共享相同的内存地址，而不是直接赋值
         # 注册成缓冲区不参与梯度计算，persistent=False表示缓冲区是否应该被保存为模型状态的一部分
-        self.register_buffer("pos_cis", precompute_pos_cis(params.dim // params.n_heads, params.max_seq_len,
-                                                           theta=params.rope_theta), persistent=False)
+        pos_cos, pos_sin = precompute_pos_cis(params.dim // params.n_heads, params.max_seq_len, theta=params.rope_theta)
+        self.register_buffer("pos_cos", pos_cos, persistent=False)
+        self.register_buffer("pos_sin", pos_sin, persistent=False)
         self.OUT = CausalLMOutputWithPast()
+        if params.compile_model:
+            # reduce-overhead会用CUDA Graphs录制forward，融合逐元素算子并摊薄seq_len=1解码时大量小kernel的launch开销
+            # 用nn.Module.compile而不是把编译后的forward赋给实例属性，模型仍可以被torch.save/pickle
+            self.compile(mode="reduce-overhead", dynamic=True, fullgraph=False)
 
     def forward(self,
                 input_ids: Optional[torch.Tensor] = None,
-                past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+                past_key_values: Optional[List[Tuple[torch.Tensor, torch.Tensor, int]]] = None,
                 use_cache: bool = False,
                 **args): # 训练时不使用kvcache，所以默认为false
         past_key_values = past_key_values or [None] * len(self.layers)
         start_pos = args.get('start_pos', 0)
-        h = self.dropout(self.tok_embeddings(input_ids))
-        pos_cis = self.pos_cis[start_pos:start_pos + input_ids.size(1)]
+        attention_mask = args.get('attention_mask', None)
+        attn_mask = None
+        if attention_mask is not None:
+            # attention_mask shape(bsz,start_pos+seq_len)，1为有效token，0为padding
+            # 构造shape为(bsz,1,seq_len,start_pos+seq_len)的布尔掩码：满足因果且key不是padding；
+            # padding位置自己的query不屏蔽padding的key，保证每行至少有一个可见位置，softmax不会出现NaN
+            seq_len, kv_len = input_ids.size(1), attention_mask.size(1)
+            key_valid = attention_mask.bool()[:, None, None, :]
+            query_pad = ~attention_mask.bool()[:, None, -seq_len:, None]
+            causal = (torch.arange(kv_len - seq_len, kv_len, device=input_ids.device)[:, None]
+                      >= torch.arange(kv_len, device=input_ids.device)[None, :])
+            attn_mask = causal & (key_valid | query_pad)
+        h = self.tok_embeddings(input_ids)
+        if self.training and self.dropout.p > 0:
+            h = self.dropout(h)
+        pos_cis = (self.pos_cos[start_pos:start_pos + input_ids.size(1)],
+                   self.pos_sin[start_pos:start_pos + input_ids.size(1)])
         past_kvs = []
         for l, layer in enumerate(self.layers):
             h, past_kv = layer(
                 h, pos_cis,
                 past_key_value=past_key_values[l],
-                use_cache=use_cache
+                use_cache=use_cache,
+                start_pos=start_pos,
+                attn_mask=attn_mask
             )
             past_kvs.append(past_kv)
         logits = self.output(self.norm(h))
-        aux_loss = sum(l.feed_forward.aux_loss for l in self.layers if isinstance(l.feed_forward, MOEFeedForward))
+        # 辅助损失只在训练时有意义，推理(如generate)时MoEGate本就返回0，直接跳过求和
+        aux_loss = sum(self.layers[i].feed_forward.aux_loss for i in self._moe_layer_indices) if self.training else 0
         self.OUT.__setitem__('logits', logits)
         self.OUT.__setitem__('aux_loss', aux_loss)
         self.OUT.__setitem__('past_key_values', past_kvs)
@@ -377,46 +499,103 @@ class MiniMindLM(PreTrainedModel):
         if stream:
             return self._stream(input_ids, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args)
 
-        # 直接生成
+        # 直接生成：去掉各行的padding后统一左侧padding，整批一起解码，而不是逐条调用_stream
+        non_pads = [seq[seq != pad_token_id] for seq in input_ids]
+        prompt_len = max(seq.size(0) for seq in non_pads)
+        padded = input_ids.new_full((len(non_pads), prompt_len), pad_token_id)
+        attention_mask = torch.zeros_like(padded, dtype=torch.bool)
+        for i, seq in enumerate(non_pads):
+            padded[i, prompt_len - seq.size(0):] = seq
+            attention_mask[i, prompt_len - seq.size(0):] = True
+        # 各行等长时不需要padding掩码，注意力可以继续走is_causal
+        if attention_mask.all():
+            attention_mask = None
+        out = padded
+        for out in self._stream_batched(padded, attention_mask, eos_token_id, max_new_tokens, temperature, top_p, rp,
+                                        use_cache, pad_token_id, **args):
+            pass
         generated = []
-        for i in range(input_ids.size(0)):
-            non_pad = input_ids[i][input_ids[i] != pad_token_id].unsqueeze(0)
-            out = self._stream(non_pad, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args)
-            tokens_list = [tokens[:, -1:] for tokens in out]
-            gen = torch.cat(tokens_list, dim=-1) if tokens_list else non_pad
-            full_sequence = torch.cat([non_pad, gen], dim=-1)
-            generated.append(full_sequence)
-        max_length = max(seq.size(1) for seq in generated)
+        for seq, gen in zip(non_pads, out[:, prompt_len:]):
+            # 与逐条生成保持一致：每行最多生成到max_new_tokens-1的长度，并在第一个eos处截断（保留eos）
+            gen = gen[:max(max_new_tokens - 1 - seq.size(0), 0)]
+            eos_pos = (gen == eos_token_id).nonzero()
+            if eos_pos.numel():
+                gen = gen[:eos_pos[0, 0] + 1]
+            generated.append(torch.cat([seq, gen]))
+        max_length = max(seq.size(0) for seq in generated)
         generated = [
             torch.cat(
-                [seq, torch.full((1, max_length - seq.size(1)), pad_token_id, dtype=seq.dtype, device=seq.device)],
+                [seq, torch.full((max_length - seq.size(0),), pad_token_id, dtype=seq.dtype, device=seq.device)],
                 dim=-1)
             for seq in generated
         ]
-        return torch.cat(generated, dim=0)
+        return torch.stack(generated, dim=0)
 
     def _stream(self, input_ids, eos_token_id, max_new_tokens, temperature, top_p, rp, use_cache, **args):
-        start, first_seq, past_kvs = input_ids.shape[1], True, None
-        while input_ids.shape[1] < max_new_tokens - 1:
+        start = input_ids.shape[1]
+        for input_ids in self._stream_batched(input_ids, None, eos_token_id, max_new_tokens, temperature, top_p, rp,
+                                              use_cache, **args):
+            yield input_ids[:, start:]
+
+    def _stream_batched(self, input_ids, attention_mask, eos_token_id, max_new_tokens, temperature, top_p, rp,
+                        use_cache, pad_token_id=0, **args):
+        """
+        整批一起解码，每步yield当前完整的input_ids
+        attention_mask:shape(bsz,seq_len)，左侧padding的位置为0，为None表示没有padding
+        """
+        bsz, start = input_ids.shape
+        first_seq, past_kvs = True, None
+        valid = attention_mask if attention_mask is not None else torch.ones_like(input_ids, dtype=torch.bool)
+        # 每行实际长度达到max_new_tokens-1，或生成了eos之后，该行就结束，之后只补pad
+        lengths = valid.sum(dim=-1)
+        finished = lengths >= max_new_tokens - 1
+        # 在device上维护每行已出现过的token的掩码并逐步更新，padding不计入
+        seen = torch.zeros(bsz, self.params.vocab_size, dtype=torch.int, device=input_ids.device)
+        seen = seen.scatter_add_(1, input_ids, valid.int()).bool()
+        while not finished.all() and input_ids.shape[1] < self.params.max_seq_len:
             if first_seq or not use_cache:
-                out, first_seq = self(input_ids, past_key_values=past_kvs, use_cache=use_cache, **args), False
+                out, first_seq = self(input_ids, past_key_values=past_kvs, use_cache=use_cache,
+                                      attention_mask=attention_mask, **args), False
             else:
                 out = self(input_ids[:, -1:], past_key_values=past_kvs, use_cache=use_cache,
-                           start_pos=input_ids.shape[1] - 1, **args)
+                           start_pos=input_ids.shape[1] - 1, attention_mask=attention_mask, **args)
             logits, past_kvs = out.logits[:, -1, :], out.past_key_values
-            logits[:, list(set(input_ids.tolist()[0]))] /= rp
+            logits = torch.where(seen, logits / rp, logits)
             logits /= (temperature + 1e-9)
+            candidate_indices = None
             if top_p is not None and top_p < 1.0:
-                sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
-                sorted_probs = F.softmax(sorted_logits, dim=-1)
-                cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-                sorted_indices_to_remove[:, 0] = False
-                indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-                logits[indices_to_remove] = -float('Inf')
-            input_ids_next = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+                # 先只取概率最大的K(256)个候选做cumsum，代替对整个词表排序；
+                # 只有当这K个候选的累计概率仍不超过top_p时，才退回对整个词表排序
+                topk_probs, topk_indices = F.softmax(logits, dim=-1).topk(min(256, logits.size(-1)), dim=-1)
+                cumulative_probs = torch.cumsum(topk_probs, dim=-1)
+                if (cumulative_probs[:, -1] > top_p).all():
+                    sorted_indices_to_remove = cumulative_probs > top_p
+                    sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+                    sorted_indices_to_remove[:, 0] = False
+                    # 之后只在这K个候选上采样
+                    logits = logits.gather(-1, topk_indices).masked_fill(sorted_indices_to_remove, -float('Inf'))
+                    candidate_indices = topk_indices
+                else:
+                    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+                    sorted_probs = F.softmax(sorted_logits, dim=-1)
+                    cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+                    sorted_indices_to_remove = cumulative_probs > top_p
+                    sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+                    sorted_indices_to_remove[:, 0] = False
+                    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+                    logits[indices_to_remove] = -float('Inf')
+            # Gumbel-max采样：argmax(logits + Gumbel噪声)与按softmax(logits)做multinomial同分布，省去一次softmax；
+            # 被top_p去掉的位置是-inf，加上噪声后仍是-inf，不会被采到
+            # 噪声必须在float32下生成：bf16的均匀分布只有约8位精度，会截断Gumbel的尾部，使采样分布有偏
+            gumbel = -torch.log(-torch.log(torch.rand_like(logits, dtype=torch.float32).clamp_min_(1e-20)))
+            input_ids_next = (logits.float() + gumbel).argmax(dim=-1, keepdim=True)
+            if candidate_indices is not None:
+                input_ids_next = candidate_indices.gather(-1, input_ids_next) # 候选中的位置映射回词表id
+            input_ids_next = input_ids_next.masked_fill(finished[:, None], pad_token_id)
             input_ids = torch.cat((input_ids, input_ids_next), dim=1)
-            yield input_ids[:, start:]
-            if input_ids_next.item() == eos_token_id:
-                break
+            if attention_mask is not None:
+                attention_mask = torch.cat((attention_mask, ~finished[:, None]), dim=1)
+            seen.scatter_(1, input_ids_next, True)
+            lengths += 1
+            finished |= (input_ids_next[:, 0] == eos_token_id) | (lengths >= max_new_tokens - 1)
+            yield input_ids
@@ -0,0 +1,44 @@
+import torch
+from torch import nn
+
+from .model import Attention, FeedForward
+
+
+def int8_kernel_available(device) -> bool:
+    # _weight_int8pack_mm在旧版本(如requirements中的torch==2.2)中不存在，且只在部分设备上有实现
+    device_type = torch.device(device).type.upper()
+    return hasattr(torch.ops.aten, '_weight_int8pack_mm') and \
+        torch._C._dispatch_has_kernel_for_dispatch_key('aten::_weight_int8pack_mm', device_type)
+
+
+# 定义INT8权重量化的线性层(W8A16)：权重按输出通道对称量化为int8，激活保持原来的dtype
+class Int8Linear(nn.Module):
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        self.in_features, self.out_features = linear.in_features, linear.out_features
+        weight = linear.weight.data.float()
+        scale = weight.abs().amax(dim=1).clamp_min(1e-8) / 127  # 每个输出通道一个缩放系数，shape(out_features,)
+        self.register_buffer('weight_int8', torch.round(weight / scale[:, None]).clamp(-128, 127).to(torch.int8))
+        self.register_buffer('scale', scale.half())
+        self.bias = linear.bias
+
+    def forward(self, x):
+        shape = x.shape
+        # _weight_int8pack_mm只接受二维输入，scale需与x同dtype
+        out = torch.ops.aten._weight_int8pack_mm(x.reshape(-1, self.in_features), self.weight_int8, self.scale.to(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias
+        return out.view(*shape[:-1], self.out_features)
+
+
+def apply_int8(model, device):
+    # 没有int8 kernel时只能每次先反量化出完整精度的权重，读写的字节数反而比不量化更多，因此直接拒绝
+    if not int8_kernel_available(device):
+        raise RuntimeError(f'PyTorch {torch.__version__} 在 {device} 上没有 _weight_int8pack_mm 算子，无法进行INT8推理')
+    # 只量化Attention与FeedForward中的nn.Linear(含共享专家)，嵌入层与共享权重的输出层保持原dtype以保证精度
+    # 已挂载LoRA的层保持原样，以免丢失LoRA分支
+    for module in list(model.modules()):
+        if isinstance(module, (Attention, FeedForward)):
+            for name, child in list(module.named_children()):
+                if isinstance(child, nn.Linear) and not hasattr(child, 'lora'):
+                    setattr(module, name, Int8Linear(child))
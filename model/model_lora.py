@@ -30,10 +30,24 @@ def apply_lora(model, rank=16):
                 return layer1(x) + layer2(x)
 
             module.forward = forward_with_lora
+        elif hasattr(module, 'qkv_split'):
+            # Attention的q,k,v投影已融合为wqkv(非方阵)，LoRA只加在q对应的输出切片上，等价于原先挂在wq上的LoRA
+            wqkv, q_dim = module.wqkv, module.qkv_split[0]
+            lora = LoRA(wqkv.in_features, q_dim, rank=rank).to(model.device)
+            setattr(wqkv, "lora", lora)
+            original_forward = wqkv.forward
+
+            def forward_with_lora(x, layer1=original_forward, layer2=lora, q_dim=q_dim):
+                out = layer1(x)
+                return torch.cat([out[..., :q_dim] + layer2(x), out[..., q_dim:]], dim=-1)
+
+            wqkv.forward = forward_with_lora
 
 
 def load_lora(model, path):
     state_dict = torch.load(path, map_location=model.device)
+    # 兼容旧的LoRA权重：wq融合进wqkv之后，原先wq上的LoRA对应wqkv的q切片
+    state_dict = {k.replace('.attention.wq.lora.', '.attention.wqkv.lora.'): v for k, v in state_dict.items()}
     for name, module in model.named_modules():
         if hasattr(module, 'lora'):
             lora_state = {k.replace(f'{name}.lora.', ''): v for k, v in state_dict.items() if f'{name}.lora.' in k}